@@ -1,20 +1,31 @@
 import asyncio
+import concurrent.futures
+import hashlib
+import json
+import logging
 import os
+import re
+import tempfile
+import threading
 from pathlib import Path
 from typing import Any, Dict
 
-import nest_asyncio
 from dotenv import load_dotenv
-from dp.agent.adapter.adk import CalculationMCPToolset
+from dp.agent.adapter.adk import CalculationMCPTool, CalculationMCPToolset
+from dp.agent.adapter.adk.client.calculation_mcp_tool import (
+    MCPSessionManagerWithLoggingCallback, logging_handler)
 from google.adk.agents import LlmAgent
 from google.adk.models.lite_llm import LiteLlm
 from google.adk.runners import Runner
 from google.adk.sessions import InMemorySessionService
+from google.adk.tools.mcp_tool import MCPTool
 from google.adk.tools.mcp_tool.mcp_session_manager import SseServerParams
 from google.genai import types
+from mcp import types as mcp_types
 
 load_dotenv()
-nest_asyncio.apply()
+
+logger = logging.getLogger(__name__)
 
 
 # Global Configuration
@@ -45,27 +56,486 @@ BOHRIUM_STORAGE = {
     "password": os.getenv("BOHRIUM_PASSWORD"),
     "project_id": int(os.getenv("BOHRIUM_PROJECT_ID"))
 }
+# Structure building is cheap, so run it on the MCP server host instead of
+# in the Bohrium container
+EXECUTOR_MAP = {
+    "build_structure": LOCAL_EXECUTOR,
+}
+# Maximum number of concurrent jobs per executor type, unlimited if absent.
+# ADK runs the function calls of one turn sequentially, so this caps jobs
+# across sessions sharing the process.
+EXECUTOR_CONCURRENCY = {
+    "dispatcher": int(os.getenv("DPA_BOHRIUM_CONCURRENCY", 4)),
+}
+
+
+# Comma separated list of MCP servers, e.g. one per calculation backend
+server_urls = [
+    url.strip() for url in os.getenv(
+        "DPA_MCP_SERVER_URLS", "http://47.92.30.41:50001/sse").split(",")
+    if url.strip()
+]
+
+# Tool manifests discovered from MCP servers, keyed by sha256 of the server url
+CACHE_DIR = Path.home() / ".cache" / "dpa_agent"
+TOOLS_CACHE_FILE = CACHE_DIR / "mcp_tools.json"
+TOOLS_CACHE_VERSION = 1
+
+# Results of deterministic tools, keyed by server url, storage project, tool
+# name and arguments. Set DPA_MCP_NO_CACHE=1 (or pass no_cache=True to a tool)
+# to bypass it.
+RESULTS_CACHE_DIR = CACHE_DIR / "results"
+# Artifact URIs whose key contains a job hash or an upload UUID are never
+# rewritten, so only those identify their content
+IMMUTABLE_URI = re.compile(
+    r"^\w+://.*/([0-9a-f]{40}|[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12})/",
+    re.IGNORECASE)
+CACHEABLE_TOOLS = {"build_structure", "optimize_crystal_structure"}
+NO_CACHE = os.getenv("DPA_MCP_NO_CACHE", "").lower() in ("1", "true", "yes")
+
+# Deadlines in seconds for MCP discovery and for a single calculation tool call
+MCP_TIMEOUT = float(os.getenv("DPA_MCP_TIMEOUT", 30))
+MCP_TOOL_TIMEOUT = float(os.getenv("DPA_MCP_TOOL_TIMEOUT", 3600))
+
+
+class _MCPLoop:
+    """Background event loop thread that owns every MCP session.
+
+    The MCP client keeps anyio cancel scopes open for the lifetime of a
+    session, so sessions must stay on one loop instead of whichever loop the
+    caller happens to run.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever,
+                                 name="mcp-loop", daemon=True).start()
+            return self._loop
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop())
+
+    async def run(self, coro, timeout=None):
+        return await asyncio.wrap_future(
+            self.submit(asyncio.wait_for(coro, timeout)))
+
+
+_mcp_loop = _MCPLoop()
+
+# Only ever acquired on _mcp_loop
+_executor_semaphores = {
+    executor_type: asyncio.Semaphore(limit)
+    for executor_type, limit in EXECUTOR_CONCURRENCY.items()
+}
+
+
+class _LoopBoundSessionManager(MCPSessionManagerWithLoggingCallback):
+    """Session manager that enters and exits each session in one owner task.
+
+    Must be used from ``_mcp_loop``.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._lock = asyncio.Lock()
+        self._owner = None
+        self._closing = None
+
+    async def create_session(self):
+        async with self._lock:
+            if self._session is None:
+                ready = asyncio.get_running_loop().create_future()
+                self._closing = asyncio.Event()
+                self._owner = asyncio.create_task(self._own_session(ready))
+                # A cancelled caller must not cancel the owner's handshake
+                await asyncio.shield(ready)
+        return self._session
+
+    async def _own_session(self, ready):
+        try:
+            await super().create_session()
+        except Exception as e:
+            ready.set_exception(e)
+            return
+        ready.set_result(None)
+        await self._closing.wait()
+        await super().close()
+
+    async def close(self):
+        async with self._lock:
+            if self._owner is not None:
+                self._closing.set()
+                await self._owner
+                self._owner = None
+
+
+class _LoopBoundMCPTool(CalculationMCPTool):
+    _semaphore = None
+
+    async def run_async(self, *, args, tool_context):
+        # Copy so ADK's function_call.args keeps what the model sent
+        args = dict(args)
+        no_cache = args.pop("no_cache", False) or NO_CACHE
+        cache_file = None
+        if (self.name in CACHEABLE_TOOLS and not no_cache
+                and self._has_immutable_inputs(args)):
+            cache_file = RESULTS_CACHE_DIR / f"{self._result_key(args)}.json"
+            try:
+                return mcp_types.CallToolResult.model_validate_json(
+                    cache_file.read_text())
+            except (OSError, ValueError):
+                pass
+        try:
+            response = await _mcp_loop.run(self._call(args, tool_context))
+        except Exception as e:
+            # Always answer the model's function_call: a call left without a
+            # tool response makes OpenAI-compatible APIs reject every later
+            # request in the session
+            logger.warning("MCP tool %s failed", self.name, exc_info=True)
+            return mcp_types.CallToolResult(
+                isError=True,
+                content=[mcp_types.TextContent(
+                    type="text", text=f"Tool {self.name} failed: {e!r}")],
+            )
+        if cache_file is not None and not response.isError:
+            try:
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                with tempfile.NamedTemporaryFile(
+                        "w", dir=cache_file.parent, suffix=".tmp",
+                        delete=False) as tmp_file:
+                    tmp_file.write(response.model_dump_json())
+                os.replace(tmp_file.name, cache_file)
+            except OSError:
+                logger.warning("Failed to write MCP result cache %s",
+                               cache_file, exc_info=True)
+        return response
+
+    async def _call(self, args, tool_context):
+        # MCP_TOOL_TIMEOUT bounds the call itself, not the wait for a slot
+        call = super().run_async(args=args, tool_context=tool_context)
+        if self._semaphore is None:
+            return await asyncio.wait_for(call, MCP_TOOL_TIMEOUT)
+        async with self._semaphore:
+            return await asyncio.wait_for(call, MCP_TOOL_TIMEOUT)
+
+    @staticmethod
+    def _has_immutable_inputs(args):
+        # Input files are passed as artifact URIs or local paths and are
+        # downloaded by the server, so a result is only reusable when every
+        # such argument names content that cannot change
+        for value in args.values():
+            if not isinstance(value, str):
+                continue
+            looks_like_file = "://" in value or "/" in value or Path(value).suffix
+            if looks_like_file and not IMMUTABLE_URI.match(value):
+                return False
+        return True
+
+    def _result_key(self, args):
+        # Executor and storage are injected after this point; only their
+        # non-secret fields go into the key. Output artifacts live in the
+        # storage project that produced them.
+        storage = self.storage or {}
+        request = {
+            "url": self._mcp_session_manager._connection_params.url,
+            "storage": {
+                "type": storage.get("type"),
+                "project_id": storage.get("project_id"),
+            },
+            "tool": self.name,
+            "args": args,
+        }
+        return hashlib.sha256(json.dumps(
+            request, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class CachedCalculationMCPToolset(CalculationMCPToolset):
+    """CalculationMCPToolset that persists the discovered tool manifest.
 
+    The first successful discovery is written to ``TOOLS_CACHE_FILE``. Later
+    processes rebuild the tools from the cache without waiting for the SSE
+    handshake, and refresh the manifest from the server in the background.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._mcp_session_manager = _LoopBoundSessionManager(
+            connection_params=self._connection_params,
+            errlog=self._errlog,
+            logging_callback=logging_handler,
+        )
+        self._cache_key = hashlib.sha256(
+            self._connection_params.url.encode()).hexdigest()
+        self._tools = None
+        self._refresh_task = None
+
+    async def get_tools(self, readonly_context=None):
+        if self._tools is None:
+            manifest = self._load_manifest()
+            if manifest is None:
+                await self._refresh_tools()
+            else:
+                self._tools = self._build_tools(manifest)
+                self._refresh_task = _mcp_loop.submit(
+                    self._refresh_tools(background=True))
+        return [tool for tool in self._tools
+                if self._is_tool_selected(tool, readonly_context)]
+
+    async def _refresh_tools(self, background: bool = False):
+        try:
+            tools = await _mcp_loop.run(super().get_tools(),
+                                        timeout=MCP_TIMEOUT)
+        except Exception:
+            if not background:
+                raise
+            logger.warning("Failed to refresh MCP tools from %s",
+                           self._connection_params.url, exc_info=True)
+            return
+        self._tools = [self._bind_tool(tool) for tool in tools]
+        # Every save runs on _mcp_loop, so saves from several toolsets never
+        # interleave their read-modify-write of the shared cache file
+        await _mcp_loop.run(self._save_manifest([
+            {
+                "name": tool.name,
+                "description": tool.description,
+                "input_schema": tool._mcp_tool.inputSchema,
+            }
+            for tool in tools
+        ]))
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+        await _mcp_loop.run(super().close(), timeout=MCP_TIMEOUT)
+
+    def _bind_tool(self, tool):
+        executor = self.executor_map.get(tool.name, self.executor)
+        bound_tool = _LoopBoundMCPTool(executor=executor, storage=self.storage)
+        bound_tool.__dict__.update(tool.__dict__)
+        bound_tool._semaphore = _executor_semaphores.get(
+            (executor or {}).get("type"))
+        if tool.name in CACHEABLE_TOOLS:
+            # Declare the client-side no_cache argument so the model can
+            # pass it; run_async pops it before the call reaches the server
+            schema = dict(tool._mcp_tool.inputSchema)
+            schema["properties"] = {
+                **schema.get("properties", {}),
+                "no_cache": {
+                    "type": "boolean",
+                    "description": (
+                        "Set to true to ignore previously cached results "
+                        "and run the calculation again."),
+                },
+            }
+            bound_tool._mcp_tool = tool._mcp_tool.model_copy(
+                update={"inputSchema": schema})
+        return bound_tool
+
+    def _build_tools(self, manifest):
+        return [
+            self._bind_tool(MCPTool(
+                mcp_tool=mcp_types.Tool(
+                    name=entry["name"],
+                    description=entry["description"],
+                    inputSchema=entry["input_schema"],
+                ),
+                mcp_session_manager=self._mcp_session_manager,
+            ))
+            for entry in manifest
+        ]
+
+    def _load_manifest(self):
+        try:
+            entry = json.loads(TOOLS_CACHE_FILE.read_text())[self._cache_key]
+        except (OSError, ValueError, KeyError):
+            return None
+        if entry.get("version") != TOOLS_CACHE_VERSION:
+            return None
+        return entry["tools"]
+
+    async def _save_manifest(self, tools):
+        try:
+            cache = json.loads(TOOLS_CACHE_FILE.read_text())
+        except (OSError, ValueError):
+            cache = {}
+        cache[self._cache_key] = {
+            "version": TOOLS_CACHE_VERSION,
+            "url": self._connection_params.url,
+            "tools": tools,
+        }
+        try:
+            TOOLS_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    "w", dir=TOOLS_CACHE_FILE.parent, suffix=".tmp",
+                    delete=False) as tmp_file:
+                json.dump(cache, tmp_file, indent=2)
+            os.replace(tmp_file.name, TOOLS_CACHE_FILE)
+        except OSError:
+            logger.warning("Failed to write MCP tool cache %s",
+                           TOOLS_CACHE_FILE, exc_info=True)
 
-server_url = "http://47.92.30.41:50001/sse"
 
 # Initialize MCP tools and agent
-mcp_tools = CalculationMCPToolset(
-    connection_params=SseServerParams(url=server_url),
-    storage=BOHRIUM_STORAGE,
-    executor=BOHRIUM_EXECUTOR
-)
-
-
-root_agent = LlmAgent(
-    model=LiteLlm(model="deepseek/deepseek-chat"),
-    name="dpa_calculations_agent",
-    description="An agent specialized in computational research using Deep Potential",
-    instruction=(
-        "You are an expert in materials science and computational chemistry. "
-        "Help users perform Deep Potential calculations including structure optimization, molecular dynamics and property calculations. "
-        "Use default parameters if the users do not mention, but let users confirm them before submission. "
-        "Always verify the input parameters to users and provide clear explanations of results."
-    ),
-    tools=[mcp_tools],
-)
+def build_toolsets():
+    return [
+        CachedCalculationMCPToolset(
+            connection_params=SseServerParams(url=url),
+            storage=BOHRIUM_STORAGE,
+            executor=BOHRIUM_EXECUTOR,
+            executor_map=EXECUTOR_MAP,
+        )
+        for url in server_urls
+    ]
+
+
+def build_agent(toolsets):
+    return LlmAgent(
+        model=LiteLlm(model="deepseek/deepseek-chat"),
+        name="dpa_calculations_agent",
+        description="An agent specialized in computational research using Deep Potential",
+        instruction=(
+            "You are an expert in materials science and computational chemistry. "
+            "Help users perform Deep Potential calculations including structure optimization, molecular dynamics and property calculations. "
+            "Use default parameters if the users do not mention, but let users confirm them before submission. "
+            "Always verify the input parameters to users and provide clear explanations of results."
+        ),
+        tools=toolsets,
+    )
+
+
+async def build_root_agent():
+    """Build the agent with tools discovered from all MCP servers concurrently.
+
+    Unreachable servers are logged and left out; startup only fails if no
+    server can be reached.
+    """
+    toolsets = build_toolsets()
+    results = await asyncio.gather(
+        *(toolset.get_tools() for toolset in toolsets), return_exceptions=True)
+    available = []
+    for toolset, result in zip(toolsets, results):
+        if isinstance(result, Exception):
+            logger.warning("Skipping MCP server %s: %r",
+                           toolset._connection_params.url, result)
+            await toolset.close()
+        else:
+            available.append(toolset)
+    if not available:
+        raise RuntimeError(
+            f"No MCP server could be reached out of {server_urls}")
+    return build_agent(available)
+
+
+# Toolsets connect lazily, so building the agent at import does no network I/O
+root_agent = build_agent(build_toolsets())
+
+
+async def _print_events(events_async):
+    """Print agent events, decoupling stdout from the event stream."""
+    queue = asyncio.Queue(maxsize=64)
+
+    async def produce():
+        # Drive and close the runner generator from this one task, since ADK
+        # keeps tracing spans (context vars) open across its yields. Tool
+        # calls are already bounded by MCP_TOOL_TIMEOUT.
+        try:
+            async for event in events_async:
+                await queue.put(event)
+        finally:
+            await events_async.aclose()
+        await queue.put(None)
+
+    async def consume():
+        while (event := await queue.get()) is not None:
+            if event.content and event.content.parts:
+                for part in event.content.parts:
+                    if part.text:
+                        print(f"🤖 Agent: {part.text}")
+
+    producer = asyncio.create_task(produce())
+    consumer = asyncio.create_task(consume())
+    try:
+        await asyncio.gather(producer, consumer)
+    finally:
+        producer.cancel()
+        consumer.cancel()
+        await asyncio.gather(producer, consumer, return_exceptions=True)
+
+
+async def _ainput(prompt):
+    """input() in a daemon thread, so Ctrl-C at the prompt still exits.
+
+    asyncio.to_thread would use the default executor, whose worker threads
+    are joined at shutdown and keep the process alive until Enter is pressed.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def read():
+        try:
+            result, error = input(prompt), None
+        except Exception as e:
+            result, error = None, e
+        try:
+            loop.call_soon_threadsafe(resolve, result, error)
+        except RuntimeError:
+            pass  # The loop is already closed
+
+    threading.Thread(target=read, name="repl-input", daemon=True).start()
+    return await future
+
+
+async def run_dpa_calculators():
+    agent = await build_root_agent()
+    session_service = InMemorySessionService()
+    session = await session_service.create_session(
+        app_name="dpa_calculator", user_id="user")
+    runner = Runner(
+        agent=agent,
+        app_name="dpa_calculator",
+        session_service=session_service,
+    )
+
+    print("🚀 Starting calculations with DPA model...")
+    try:
+        while True:
+            try:
+                user_input = await _ainput("🧑 User: ")
+            except EOFError:
+                break
+            if user_input.strip().lower() in ("exit", "quit"):
+                break
+            content = types.Content(
+                role="user", parts=[types.Part(text=user_input)])
+            events_async = runner.run_async(
+                user_id=session.user_id,
+                session_id=session.id,
+                new_message=content,
+            )
+            try:
+                await _print_events(events_async)
+            except Exception as e:
+                # Report failed turns (timeouts, MCP or LLM errors) and keep
+                # the session alive
+                print(f"❌ Error: {e!r}")
+    finally:
+        for toolset in agent.tools:
+            await toolset.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_dpa_calculators())
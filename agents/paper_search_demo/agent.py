@@ -1,5 +1,6 @@
 import openai
 import asyncio
+import functools
 import os
 from pathlib import Path
 from typing import Any, Dict
@@ -25,23 +26,37 @@ os.environ["AZURE_OPENAI_API_KEY"] = ""
 os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"] = ""
 
 
-toolset = CalculationMCPToolset(
-    connection_params=SseServerParams(
-        url="http://47.92.30.41:50001/sse",
-    ),
-)
+@functools.lru_cache(maxsize=None)
+def get_toolset():
+    return CalculationMCPToolset(
+        connection_params=SseServerParams(
+            url="http://47.92.30.41:50001/sse",
+        ),
+    )
 
 use_model = "deepseek"
 
-if use_model == "deepseek":
-    model = LiteLlm(model="deepseek/deepseek-chat")
-if use_model == "gpt-4o":
-    model = LiteLlm(model="azure/gpt-4o")
-
-# Create agent
-root_agent = Agent(
-    name="mcp_sse_agent",
-    model=model,
-    instruction="You are an intelligent assistant capable of using external tools via MCP.",
-    tools=[]
-)
+
+def build_agent() -> Agent:
+    if use_model == "deepseek":
+        model = LiteLlm(model="deepseek/deepseek-chat")
+    if use_model == "gpt-4o":
+        model = LiteLlm(model="azure/gpt-4o")
+
+    # Create agent
+    return Agent(
+        name="mcp_sse_agent",
+        model=model,
+        instruction="You are an intelligent assistant capable of using external tools via MCP.",
+        tools=[]
+    )
+
+
+# Build `toolset` and `root_agent` on first access instead of at import time
+def __getattr__(name):
+    if name == "toolset":
+        return get_toolset()
+    if name == "root_agent":
+        globals()["root_agent"] = agent = build_agent()
+        return agent
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")